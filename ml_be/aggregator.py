@@ -1,84 +1,431 @@
 import os
+
+# CPU-only, small-thread TensorFlow unless AGGREGATOR_USE_GPU=1; must run before TensorFlow is imported
+USE_GPU = os.environ.get("AGGREGATOR_USE_GPU", "0") == "1"
+if not USE_GPU:
+    os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
+os.environ.setdefault("TF_NUM_INTEROP_THREADS", "1")
+os.environ.setdefault("TF_NUM_INTRAOP_THREADS", "2")
+
+import h5py
 import numpy as np
 import tensorflow as tf
 import logging
 import keras
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional (the `fast` extra); fall back to NumPy
+    njit = None
 
 # --- Configuration ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # --- Model Creation (for Testing) ---
 
-def create_dummy_model():
+def create_dummy_model(dtype: str = 'float32'):
     """
     Creates and compiles a simple sequential Keras model for testing purposes.
     The model has a simple architecture: Input(10) -> Dense(10) -> Output(1).
     Weights are initialized randomly.
 
+    Args:
+        dtype (str): Dtype of the model's weights. Use 'float16' to produce models
+            that are half the size on disk and over the wire.
+
     Returns:
         keras.Model: A compiled Keras model.
     """
     model = keras.models.Sequential([
-        keras.layers.Input(shape=(10,)),
-        keras.layers.Dense(10, activation='relu'),
-        keras.layers.Dense(1, activation='sigmoid')
+        keras.layers.Input(shape=(10,), dtype=dtype),
+        keras.layers.Dense(10, activation='relu', dtype=dtype),
+        keras.layers.Dense(1, activation='sigmoid', dtype=dtype)
     ])
     model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
-    logging.info("Created a dummy Keras model instance.")
+    logging.info(f"Created a dummy Keras model instance ({dtype}).")
     return model
 
+# --- Flat Weight Format ---
+
+def _saved_variables(model: keras.Model) -> list[keras.Variable]:
+    """
+    Returns a model's variables in the order Keras' legacy HDF5 saver writes them:
+    each layer's trainable then non-trainable weights, followed by the model's own
+    top-level variables. For nested models with frozen or BatchNorm layers this
+    differs from `model.weights` / `get_weights()`.
+    """
+    variables = []
+    for layer in model.layers:
+        variables.extend(layer.trainable_weights + layer.non_trainable_weights)
+    # Mirrors the saver's `top_level_model_weights` group
+    model_weights = {id(v) for v in model.weights}
+    variables.extend(
+        v for v in model._trainable_variables + model._non_trainable_variables if id(v) in model_weights
+    )
+    return variables
+
+def pack_weights(model: keras.Model, dtype: str = 'float32') -> np.ndarray:
+    """
+    Packs a model's weights into a single flat vector, in the same order as its
+    .h5 file stores them.
+    Clients can upload `np.save(path, pack_weights(model))` instead of a full .h5;
+    the round's reference .h5 model is the manifest used to unpack it.
+
+    Args:
+        model (keras.Model): The model whose weights to pack.
+        dtype (str): Dtype of the packed vector ('float32' or 'float16').
+
+    Returns:
+        np.ndarray: A 1-D array holding every weight of the model.
+    """
+    weights = [np.ravel(keras.ops.convert_to_numpy(v)) for v in _saved_variables(model)]
+    return np.concatenate(weights).astype(dtype, copy=False)
+
+def _unpack_weights(flat: np.ndarray, shapes: list[tuple[int, ...]]) -> list[np.ndarray]:
+    """
+    Splits a flat weight vector into per-layer views with the given shapes, without copying.
+    """
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    if flat.ndim != 1 or flat.size != sum(sizes):
+        raise ValueError(f"Flat weights have {flat.size} values, expected {sum(sizes)}.")
+
+    weights, offset = [], 0
+    for shape, size in zip(shapes, sizes):
+        weights.append(flat[offset:offset + size].reshape(shape))
+        offset += size
+    return weights
+
 # --- Core Aggregation Logic ---
 
-def aggregate_models(model_paths: list[str]) -> keras.Model | None:
+# Clients loaded concurrently; h5py's global lock makes more threads only cost memory
+MAX_LOAD_WORKERS = 2
+
+# Template model the averaged weights are written into, reused across rounds
+_TEMPLATE: keras.Model | None = None
+_TEMPLATE_CONFIG: str | None = None
+
+def _get_template(reference_path: str) -> keras.Model:
+    """
+    Returns the cached template model, loading it from `reference_path` on first
+    use or when the reference's model config no longer matches the cached model
+    (e.g. a campaign with a different architecture or weight dtype).
+
+    Args:
+        reference_path (str): File path to a .h5 model with the expected architecture.
+
+    Returns:
+        keras.Model: The template model.
+    """
+    global _TEMPLATE, _TEMPLATE_CONFIG
+    # The config covers layer shapes and dtypes
+    with h5py.File(reference_path, 'r') as f:
+        config = f.attrs.get('model_config')
+    if isinstance(config, bytes):
+        config = config.decode('utf-8')
+    if _TEMPLATE is None or config != _TEMPLATE_CONFIG:
+        _TEMPLATE = keras.models.load_model(reference_path, compile=False)
+        _TEMPLATE_CONFIG = config
+        logging.info(f"Loaded template model from: {reference_path}")
+    return _TEMPLATE
+
+def _h5_attr_names(group: h5py.Group, name: str) -> list[str]:
+    """
+    Reads a list-of-names attribute written by Keras' HDF5 saver. Keras splits
+    lists that exceed the HDF5 attribute size limit into `name0`, `name1`, ...
+    """
+    if name in group.attrs:
+        values = list(group.attrs[name])
+    else:
+        values, chunk = [], 0
+        while f"{name}{chunk}" in group.attrs:
+            values.extend(group.attrs[f"{name}{chunk}"])
+            chunk += 1
+    return [v.decode('utf8') if isinstance(v, bytes) else v for v in values]
+
+def _iter_weights_h5(path: str) -> Iterator[h5py.Dataset]:
+    """
+    Yields the weight datasets of a Keras .h5 model file in the order the saver
+    wrote them (see `_saved_variables`), without building a Keras model.
+
+    Args:
+        path (str): File path to the .h5 model (or legacy weights-only) file.
+
+    Yields:
+        h5py.Dataset: One dataset per weight tensor. Only valid while iterating.
+    """
+    with h5py.File(path, 'r') as f:
+        group = f['model_weights'] if 'model_weights' in f else f
+        for layer_name in _h5_attr_names(group, 'layer_names'):
+            layer_group = group[layer_name]
+            for weight_name in _h5_attr_names(layer_group, 'weight_names'):
+                yield layer_group[weight_name]
+        if 'top_level_model_weights' in group:
+            top_level = group['top_level_model_weights']
+            for weight_name in _h5_attr_names(top_level, 'weight_names'):
+                yield top_level[weight_name]
+
+def _load_weights(path: str, shapes: list[tuple[int, ...]]) -> np.ndarray:
+    """
+    Reads the weights of a single client model as one flat, C-contiguous float32
+    vector, in `_saved_variables` order. The client model is either a Keras .h5 file
+    (read straight from HDF5) or a flat .npy vector written with `pack_weights`
+    (memory-mapped). The format is detected from the file contents.
+
+    Args:
+        path (str): File path to the client model.
+        shapes (list[tuple[int, ...]]): Weight shapes of the global model.
+
+    Returns:
+        np.ndarray: The model's weights as a 1-D float32 array.
+    """
+    total_params = sum(int(np.prod(shape)) for shape in shapes)
+    if not h5py.is_hdf5(path):
+        # A flat vector carries no shapes, so check its rank, kind and length
+        mapped = np.load(path, mmap_mode='r')
+        if mapped.ndim != 1 or mapped.size != total_params or mapped.dtype.kind != 'f':
+            raise ValueError(
+                f"Flat weights in {path} are {mapped.dtype} with shape {mapped.shape}, "
+                f"expected a float vector of {total_params} values."
+            )
+        # float32 stays a zero-copy view; float16 is converted here, on the loader thread
+        flat = np.ascontiguousarray(mapped, dtype=np.float32)
+        logging.info(f"Mapped flat weights from: {path}")
+        return flat
+
+    # Read each dataset into its slice of one float32 buffer, converting float16 on read
+    flat = np.empty(total_params, dtype=np.float32)
+    views = _unpack_weights(flat, shapes)
+    mismatch = ValueError(f"Weights in {path} do not match the global model architecture.")
+    count = 0
+    # The datasets are only readable while the generator keeps the file open
+    for i, dset in enumerate(_iter_weights_h5(path)):
+        if i >= len(views) or dset.shape != views[i].shape:
+            raise mismatch
+        if dset.size:
+            dset.read_direct(views[i])
+        count += 1
+    if count != len(views):
+        raise mismatch
+    logging.info(f"Loaded weights from model: {path}")
+    return flat
+
+def _prefetch(model_paths: list[str]):
+    """
+    Asks the kernel to start reading every model file into the page cache, so disk
+    (or network filesystem) latency overlaps with the template load and the first reads.
+    A no-op where `posix_fadvise` is unavailable; failures only cost the hint.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    for path in model_paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logging.debug(f"Could not prefetch {path}: {e}")
+
+def _iter_loaded_weights(model_paths: list[str], shapes: list[tuple[int, ...]]) -> Iterator[np.ndarray]:
+    """
+    Yields each model's flat weights in `model_paths` order, reading them on a
+    bounded thread pool. At most `MAX_LOAD_WORKERS` loads are in flight at once, so
+    no more than that many clients' weights are ever held in memory, however many
+    models the round has (`Executor.map` would queue every load up front).
+    """
+    workers = min(MAX_LOAD_WORKERS, len(model_paths))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        pending = deque()
+        for path in model_paths:
+            if len(pending) == workers:
+                yield pending.popleft().result()
+            pending.append(ex.submit(_load_weights, path, shapes))
+        while pending:
+            yield pending.popleft().result()
+
+# Models smaller than this are added with NumPy
+NUMBA_MIN_SIZE = 1 << 16
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _axpy_inplace(acc, w, alpha):
+        """Multi-threaded `acc += alpha * w` over two contiguous 1-D float32 arrays of equal size."""
+        for j in prange(acc.size):
+            acc[j] += alpha * w[j]
+
+# Device accumulator and compiled kernel for the last architecture, keyed by its size
+_DEVICE_ACCUMULATOR: tuple[int, tf.Variable, Callable] | None = None
+
+def _get_device_accumulator(total_params: int) -> tuple[tf.Variable, Callable]:
+    """
+    Returns a zeroed device-resident running sum of `total_params` float32 values and
+    its compiled update kernel. Like `_TEMPLATE`, only one architecture is cached: a
+    new size releases the previous buffer before compiling a new kernel.
+    """
+    global _DEVICE_ACCUMULATOR
+    if _DEVICE_ACCUMULATOR is None or _DEVICE_ACCUMULATOR[0] != total_params:
+        _DEVICE_ACCUMULATOR = None
+        acc = tf.Variable(tf.zeros([total_params], dtype=tf.float32), trainable=False)
+
+        def update(flat, alpha):
+            acc.assign_add(alpha * flat)
+
+        kernel = tf.function(
+            update,
+            input_signature=[tf.TensorSpec([total_params], tf.float32), tf.TensorSpec([], tf.float32)],
+            jit_compile=True
+        )
+        _DEVICE_ACCUMULATOR = (total_params, acc, kernel)
+
+    _, acc, kernel = _DEVICE_ACCUMULATOR
+    acc.assign(tf.zeros_like(acc))
+    return acc, kernel
+
+class _Accumulator:
+    """
+    Flat float32 running sum of client weights. Picks how each client is added and
+    owns the NumPy path's scratch buffer, which is allocated on first use and reused
+    for the rest of the round.
+
+    Args:
+        total_params (int): Number of weights in the model.
+        on_device (bool): Keep the running sum on the GPU.
+    """
+    def __init__(self, total_params: int, on_device: bool = False):
+        self._kernel = None
+        if on_device:
+            self.acc, self._kernel = _get_device_accumulator(total_params)
+        else:
+            self.acc = np.zeros(total_params, dtype=np.float32)
+        self._scratch = None
+
+    def add(self, flat: np.ndarray, alpha: float = 1.0):
+        """
+        Adds one client's flat weights, scaled by `alpha`, into the running sum in place.
+
+        Args:
+            flat (np.ndarray): The client's weights as a C-contiguous 1-D float32 array,
+                as returned by `_load_weights`.
+            alpha (float): The client's weight in the average, e.g. its sample count.
+        """
+        if self._kernel is not None:
+            self._kernel(flat, np.float32(alpha))
+        elif njit is not None and flat.size >= NUMBA_MIN_SIZE:
+            _axpy_inplace(self.acc, flat, np.float32(alpha))
+        elif alpha == 1.0:
+            np.add(self.acc, flat, out=self.acc)
+        else:
+            if self._scratch is None:
+                self._scratch = np.empty_like(self.acc)
+            np.multiply(flat, np.float32(alpha), out=self._scratch)
+            np.add(self.acc, self._scratch, out=self.acc)
+
+    def total(self) -> np.ndarray:
+        """
+        Returns the running sum as a writable host array.
+        """
+        if self._kernel is not None:
+            # Tensor buffers handed out by TF may be read-only
+            return np.array(self.acc.numpy())
+        return self.acc
+
+def aggregate_models(
+    model_paths: list[str], sample_counts: list[int] | None = None, reference_path: str | None = None
+) -> keras.Model | None:
     """
     Performs federated averaging on a list of Keras models.
 
     Args:
-        model_paths (list[str]): A list of file paths to the .h5 model files.
+        model_paths (list[str]): A list of file paths to the client models, as .h5
+            files or flat .npy weight vectors. Every path must exist.
+        sample_counts (list[int] | None): Number of training samples behind each
+            model, in `model_paths` order. Each model is weighted by its share of
+            the samples (FedAvg); all models are weighted equally when omitted.
+        reference_path (str | None): File path to a .h5 model (e.g. the current
+            global model) that defines the architecture .npy vectors are unpacked
+            against. Defaults to the first .h5 file in `model_paths`.
 
     Returns:
-        keras.Model: A new Keras model with the averaged weights.
+        keras.Model: The cached template model holding the averaged weights. It is
+            shared, not a copy: the next call in this process overwrites its
+            weights, so save or copy it before aggregating again.
         None: If aggregation fails or no models are provided.
     """
     if not model_paths:
         logging.warning("aggregate_models called with no model paths.")
         return None
+    if sample_counts is None:
+        sample_counts = [1] * len(model_paths)
+    if len(sample_counts) != len(model_paths) or any(n <= 0 for n in sample_counts):
+        logging.error("sample_counts must hold one positive count per model path.")
+        return None
 
     try:
-        # 1. Load all models and collect their weights
-        all_models_weights = []
-        for path in model_paths:
-            if os.path.exists(path):
-                model = keras.models.load_model(path)
-                all_models_weights.append(model.get_weights())
-                logging.info(f"Loaded weights from model: {path}")
-            else:
-                logging.warning(f"Model path not found, skipping: {path}")
-
-        if not all_models_weights:
-            logging.error("Could not load any models from the provided paths.")
-            return None
-
-        # 2. Calculate the average of the weights
-        avg_weights = []
-        # Iterate through each layer's weights
-        for weights_list_tuple in zip(*all_models_weights):
-            # Average the weights for the current layer across all models
-            layer_mean = np.mean(np.array(weights_list_tuple), axis=0)
-            avg_weights.append(layer_mean)
-
-        logging.info(f"Successfully averaged weights from {len(all_models_weights)} models.")
-
-        # 3. Create a new model and set the averaged weights
-        # We use the first model in the list as a template for the architecture
-        aggregated_model = keras.models.load_model(model_paths[0])
-        if aggregate_models is None:
-            raise ("Can't load model")
-        aggregated_model.set_weights(avg_weights)
-        logging.info("Created new global model and set averaged weights.")
+        _prefetch(model_paths)
+
+        # 1. Get the template model for the architecture from this round's .h5 reference
+        if reference_path is None:
+            reference_path = next((p for p in model_paths if h5py.is_hdf5(p)), None)
+        if reference_path is None:
+            raise ValueError("No .h5 model available to take the global model architecture from.")
+        aggregated_model = _get_template(reference_path)
+        variables = _saved_variables(aggregated_model)
+        shapes = [tuple(v.shape) for v in variables]
+
+        # 2. Add each client's flat weights into the running sum as soon as they are loaded
+        total_params = sum(int(np.prod(shape)) for shape in shapes)
+        # Keep the running sum on the GPU when opted in and one is available
+        accumulator = _Accumulator(total_params, on_device=USE_GPU and bool(tf.config.list_physical_devices('GPU')))
+        # Not zip/enumerate: their reused result tuple keeps the previous client alive
+        counts = iter(sample_counts)
+        for flat in _iter_loaded_weights(model_paths, shapes):
+            accumulator.add(flat, next(counts))
+            # Drop this client's weights before waiting on the next one
+            del flat
+        acc = accumulator.total()
+
+        # 3. Turn the weighted sum into the weighted average, in place
+        acc *= np.float32(1.0 / sum(sample_counts))
+
+        logging.info(f"Successfully averaged weights from {len(model_paths)} models.")
+
+        # 4. Set the averaged weights on the template model
+        for v, w in zip(variables, _unpack_weights(acc, shapes)):
+            v.assign(w)
+        logging.info("Set averaged weights on the global model.")
 
         return aggregated_model
 
     except Exception as e:
         logging.error(f"An error occurred during model aggregation: {e}", exc_info=True)
         return None
+
+def aggregate_and_save(
+    model_paths: list[str], output_path: str, sample_counts: list[int] | None = None, reference_path: str | None = None
+) -> str:
+    """
+    Aggregates the given models and saves the resulting global model. Meant to be
+    run in a worker process, so failures are raised rather than returned as None.
+
+    Args:
+        model_paths (list[str]): A list of file paths to the client models.
+        output_path (str): File path to save the aggregated .h5 model to.
+        sample_counts (list[int] | None): Per-model sample counts, see `aggregate_models`.
+        reference_path (str | None): Architecture reference .h5, see `aggregate_models`.
+
+    Returns:
+        str: The absolute path of the saved global model.
+    """
+    aggregated_model = aggregate_models(model_paths, sample_counts, reference_path)
+    if aggregated_model is None:
+        raise RuntimeError("Model aggregation failed. Check logs for details.")
+
+    # The template is uncompiled, so save just the architecture and weights
+    aggregated_model.save(output_path, include_optimizer=False)
+    return os.path.abspath(output_path)
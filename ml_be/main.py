@@ -1,20 +1,64 @@
 import os
+import asyncio
 import logging
-import requests
+import multiprocessing
+import httpx
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, BackgroundTasks, HTTPException, status
-from pydantic import BaseModel, HttpUrl
-from typing import List
+from pydantic import BaseModel, HttpUrl, PositiveInt
+from typing import Dict, List, Literal, Optional
 
-# Import the machine learning logic from our dedicated module
-from aggregator import create_dummy_model, aggregate_models
+# Entry points that run the machine learning logic in the worker processes
+import worker
 
 # --- Configuration & Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Aggregation runs in spawned worker processes so a long round does not block new requests
+AGGREGATION_WORKERS = 2
+
+def _new_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=AGGREGATION_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+_POOL = _new_pool()
+
+async def run_in_pool(fn, *args):
+    """
+    Runs `fn(*args)` in the worker pool. If a worker died (e.g. OOM-killed), the broken
+    pool is replaced so only the jobs that were running on it fail.
+    """
+    global _POOL
+    pool = _POOL
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        # Every job on the broken pool ends up here; only the first one replaces it
+        if _POOL is pool:
+            logging.error("A worker process died; replacing the aggregation pool.")
+            _POOL = _new_pool()
+            pool.shutdown(wait=False)
+        raise
+
+# One pooled HTTP client for all callbacks, so connections to the TypeScript service
+# are kept alive and reused instead of paying a TCP (and TLS) handshake per round
+_HTTP_CLIENT = httpx.AsyncClient(
+    timeout=15,
+    limits=httpx.Limits(max_keepalive_connections=16, max_connections=32)
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await _HTTP_CLIENT.aclose()
+    _POOL.shutdown(wait=False, cancel_futures=True)
+
 app = FastAPI(
     title="Federated Learning Aggregation Service",
     description="An API to aggregate TensorFlow models for a federated learning system.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Directory to save the final aggregated models
@@ -24,51 +68,75 @@ if not os.path.exists(OUTPUT_DIR):
     logging.info(f"Created output directory: {OUTPUT_DIR}")
 
 
+# Client uploads: full Keras .h5 models or flat weight vectors from aggregator.pack_weights.
+# A round of flat vectors needs a reference .h5 for the architecture, see AggregationRequest
+MODEL_EXTENSIONS = ('.h5', '.npy')
+
+
 # --- Pydantic Models for Request Validation ---
 
 class AggregationRequest(BaseModel):
     roundId: str
     models_directory: str
     callback_url: HttpUrl
+    # Training samples behind each model, keyed by file name; models are weighted equally when omitted
+    sample_counts: Optional[Dict[str, PositiveInt]] = None
+    # Path to a .h5 model (e.g. the current global model) defining the architecture;
+    # defaults to the first .h5 upload, and is required when every upload is a .npy vector
+    reference_model: Optional[str] = None
 
 class TestModelRequest(BaseModel):
     num_models: int = 3
     test_dir: str = "test_models/round_test"
+    dtype: Literal["float32", "float16"] = "float32"
 
 
 # --- Background Task for Aggregation ---
 
-def run_aggregation_and_callback(round_id: str, models_dir: str, callback_url: str):
+async def run_aggregation_and_callback(
+    round_id: str,
+    models_dir: str,
+    callback_url: str,
+    sample_counts: Optional[Dict[str, int]] = None,
+    reference_model: Optional[str] = None
+):
     """
-    This function runs in the background to perform the heavy lifting of model aggregation.
+    This function runs in the background and hands the heavy lifting of model aggregation
+    to the worker process pool, then reports the result to the callback URL.
     """
     logging.info(f"[{round_id}] Starting aggregation process for models in: {models_dir}")
 
     try:
         # Find all model files in the specified directory
-        model_paths = [os.path.join(models_dir, f) for f in os.listdir(models_dir) if f.endswith('.h5')]
+        with os.scandir(models_dir) as it:
+            model_paths = [e.path for e in it if e.is_file() and e.name.endswith(MODEL_EXTENSIONS)]
 
         if not model_paths:
-            raise ValueError("No model files (.h5) found in the specified directory.")
+            raise ValueError("No model files (.h5 or .npy) found in the specified directory.")
 
         logging.info(f"[{round_id}] Found {len(model_paths)} models to aggregate.")
 
-        # Perform the aggregation using our helper function
-        aggregated_model = aggregate_models(model_paths)
-        if aggregated_model is None:
-             raise Exception("Model aggregation failed. Check logs for details.")
+        # Line the per-model sample counts up with the model paths
+        counts = None
+        if sample_counts is not None:
+            missing = [os.path.basename(p) for p in model_paths if os.path.basename(p) not in sample_counts]
+            if missing:
+                raise ValueError(f"No sample count provided for models: {', '.join(missing)}")
+            counts = [sample_counts[os.path.basename(p)] for p in model_paths]
 
-        # Save the new global model to the output directory
+        # Aggregate and save the new global model in a worker process
         output_filename = f"global_model_{round_id}.h5"
-        aggregated_model_path = os.path.join(OUTPUT_DIR, output_filename)
-        aggregated_model.save(aggregated_model_path)
+        output_path = os.path.join(OUTPUT_DIR, output_filename)
+        aggregated_model_path = await run_in_pool(
+            worker.aggregate_and_save, model_paths, output_path, counts, reference_model
+        )
         logging.info(f"[{round_id}] Aggregated model saved to: {aggregated_model_path}")
 
         # Prepare callback data
         callback_data = {
             "roundId": round_id,
             "status": "success",
-            "aggregated_model_path": os.path.abspath(aggregated_model_path)
+            "aggregated_model_path": aggregated_model_path
         }
         response_status = "success"
 
@@ -84,9 +152,9 @@ def run_aggregation_and_callback(round_id: str, models_dir: str, callback_url: s
     # --- Send Callback to TypeScript Service ---
     try:
         logging.info(f"[{round_id}] Sending {response_status} callback to: {callback_url}")
-        requests.post(callback_url, json=callback_data, timeout=15)
+        await _HTTP_CLIENT.post(callback_url, json=callback_data)
         logging.info(f"[{round_id}] Callback sent successfully.")
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"[{round_id}] Failed to send callback to {callback_url}: {e}")
 
 
@@ -105,13 +173,20 @@ def aggregate_endpoint(request: AggregationRequest, background_tasks: Background
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Directory not found: {request.models_directory}"
         )
+    if request.reference_model is not None and not os.path.isfile(request.reference_model):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Reference model not found: {request.reference_model}"
+        )
 
     # Add the heavy computation to the background tasks
     background_tasks.add_task(
         run_aggregation_and_callback,
         request.roundId,
         request.models_directory,
-        str(request.callback_url)
+        str(request.callback_url),
+        request.sample_counts,
+        request.reference_model
     )
 
     logging.info(f"Accepted aggregation request for round '{request.roundId}'. Process started in background.")
@@ -119,19 +194,11 @@ def aggregate_endpoint(request: AggregationRequest, background_tasks: Background
 
 
 @app.post("/create_test_models", status_code=status.HTTP_201_CREATED)
-def create_test_models_endpoint(request: TestModelRequest):
+async def create_test_models_endpoint(request: TestModelRequest):
     """
     A utility endpoint to create dummy local models for testing.
     """
-    if not os.path.exists(request.test_dir):
-        os.makedirs(request.test_dir)
-
-    for i in range(request.num_models):
-        model = create_dummy_model()
-        model_path = os.path.join(request.test_dir, f'local_model_{i+1}.h5')
-        model.save(model_path)
-
-    abs_path = os.path.abspath(request.test_dir)
+    abs_path = await run_in_pool(worker.create_test_models, request.num_models, request.test_dir, request.dtype)
     return {
         "message": f"Successfully created {request.num_models} dummy models.",
         "directory": abs_path
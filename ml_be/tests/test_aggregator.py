@@ -0,0 +1,166 @@
+import weakref
+from concurrent.futures import Future
+
+import keras
+import numpy as np
+import pytest
+
+import aggregator
+
+
+def create_nested_model():
+    """
+    A transfer-learning style model: a partly frozen backbone with BatchNorm nested
+    inside the outer model, so the HDF5 weight order differs from `get_weights()`.
+    """
+    backbone = keras.models.Sequential([
+        keras.layers.Input(shape=(4,)),
+        keras.layers.Dense(8, activation='relu'),
+        keras.layers.BatchNormalization(),
+        keras.layers.Dense(8, activation='relu')
+    ], name='backbone')
+    backbone.layers[0].trainable = False
+    model = keras.models.Sequential([
+        keras.layers.Input(shape=(4,)),
+        backbone,
+        keras.layers.Dense(1, activation='sigmoid')
+    ])
+    # Randomise every weight, BatchNorm statistics included, so a misordered read shows up
+    rng = np.random.default_rng()
+    model.set_weights([rng.standard_normal(w.shape).astype(w.dtype) for w in model.get_weights()])
+    return model
+
+
+@pytest.fixture
+def nested_model_path(tmp_path):
+    path = str(tmp_path / 'nested.h5')
+    create_nested_model().save(path)
+    return path
+
+
+def test_load_weights_matches_keras_loader(nested_model_path):
+    model = keras.models.load_model(nested_model_path, compile=False)
+    variables = aggregator._saved_variables(model)
+    shapes = [tuple(v.shape) for v in variables]
+
+    flat = aggregator._load_weights(nested_model_path, shapes)
+
+    for v, w in zip(variables, aggregator._unpack_weights(flat, shapes)):
+        np.testing.assert_array_equal(keras.ops.convert_to_numpy(v), w)
+
+
+def test_aggregate_single_nested_model_round_trips(nested_model_path):
+    expected = keras.models.load_model(nested_model_path, compile=False).get_weights()
+
+    aggregated_model = aggregator.aggregate_models([nested_model_path])
+
+    assert aggregated_model is not None
+    for actual, want in zip(aggregated_model.get_weights(), expected):
+        np.testing.assert_allclose(actual, want, rtol=1e-6)
+
+
+def test_template_reloads_when_dtype_changes(tmp_path):
+    for dtype in ('float32', 'float16'):
+        path = str(tmp_path / f'{dtype}.h5')
+        aggregator.create_dummy_model(dtype).save(path)
+
+        aggregated_model = aggregator.aggregate_models([path])
+
+        assert aggregated_model is not None
+        assert all(w.dtype == np.dtype(dtype) for w in aggregated_model.get_weights())
+
+
+def test_flat_vectors_need_a_reference_model(tmp_path):
+    reference_path = str(tmp_path / 'global.h5')
+    aggregator.create_dummy_model().save(reference_path)
+    flat_path = str(tmp_path / 'client.npy')
+    np.save(flat_path, aggregator.pack_weights(aggregator.create_dummy_model()))
+
+    assert aggregator.aggregate_models([flat_path]) is None
+    assert aggregator.aggregate_models([flat_path], reference_path=reference_path) is not None
+
+
+def test_flat_vector_of_wrong_length_is_rejected(tmp_path):
+    reference_path = str(tmp_path / 'global.h5')
+    aggregator.create_dummy_model().save(reference_path)
+    flat_path = str(tmp_path / 'client.npy')
+    np.save(flat_path, aggregator.pack_weights(aggregator.create_dummy_model())[:-1])
+
+    assert aggregator.aggregate_models([flat_path], reference_path=reference_path) is None
+
+
+def test_weighted_average_matches_hand_computed_mean(tmp_path):
+    models = [aggregator.create_dummy_model() for _ in range(3)]
+    paths = []
+    for i, model in enumerate(models):
+        paths.append(str(tmp_path / f'local_model_{i + 1}.h5'))
+        model.save(paths[-1])
+    sample_counts = [10, 30, 60]
+
+    aggregated_model = aggregator.aggregate_models(paths, sample_counts)
+
+    assert aggregated_model is not None
+    for i, actual in enumerate(aggregated_model.get_weights()):
+        expected = sum(n * m.get_weights()[i] for n, m in zip(sample_counts, models)) / sum(sample_counts)
+        np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_previous_client_is_released_before_the_next_load(tmp_path, monkeypatch):
+    paths = []
+    for i in range(5):
+        paths.append(str(tmp_path / f'local_model_{i + 1}.h5'))
+        aggregator.create_dummy_model().save(paths[-1])
+    loaded, alive_at_submit = [], []
+
+    class TrackingExecutor(aggregator.ThreadPoolExecutor):
+        """Runs each load as it is submitted, recording how many loaded clients are still alive."""
+        def submit(self, fn, *args):
+            alive_at_submit.append(sum(ref() is not None for ref in loaded))
+            future = Future()
+            future.set_result(fn(*args))
+            loaded.append(weakref.ref(future.result()))
+            return future
+
+    monkeypatch.setattr(aggregator, 'ThreadPoolExecutor', TrackingExecutor)
+
+    assert aggregator.aggregate_models(paths, [1, 2, 3, 4, 5]) is not None
+    assert max(alive_at_submit) <= aggregator.MAX_LOAD_WORKERS - 1
+
+
+@pytest.mark.parametrize('alpha', [1, 3])
+def test_numba_kernel_matches_numpy(alpha):
+    pytest.importorskip('numba')
+    rng = np.random.default_rng()
+    flat = rng.standard_normal(aggregator.NUMBA_MIN_SIZE, dtype=np.float32)
+    initial = rng.standard_normal(aggregator.NUMBA_MIN_SIZE, dtype=np.float32)
+    accumulator = aggregator._Accumulator(initial.size)
+    accumulator.acc[:] = initial
+
+    accumulator.add(flat, alpha)
+
+    np.testing.assert_allclose(accumulator.total(), initial + np.float32(alpha) * flat, rtol=1e-5, atol=1e-6)
+
+
+def test_numpy_path_allocates_scratch_only_for_scaled_adds(monkeypatch):
+    monkeypatch.setattr(aggregator, 'njit', None)
+    flat = np.ones(8, dtype=np.float32)
+    accumulator = aggregator._Accumulator(flat.size)
+
+    accumulator.add(flat)
+    assert accumulator._scratch is None
+    accumulator.add(flat, 2)
+    scratch = accumulator._scratch
+    accumulator.add(flat, 3)
+
+    assert accumulator._scratch is scratch
+    np.testing.assert_array_equal(accumulator.total(), np.full(8, 6, dtype=np.float32))
+
+
+def test_device_accumulator_keeps_only_the_latest_architecture():
+    accumulator = aggregator._Accumulator(8, on_device=True)
+    accumulator.add(np.ones(8, dtype=np.float32), 2)
+    np.testing.assert_array_equal(accumulator.total(), np.full(8, 2, dtype=np.float32))
+
+    aggregator._Accumulator(16, on_device=True)
+
+    assert aggregator._DEVICE_ACCUMULATOR[0] == 16
@@ -0,0 +1,24 @@
+import asyncio
+import importlib
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    # main creates its output directory in the working directory on import
+    monkeypatch.chdir(tmp_path)
+    module = importlib.import_module('main')
+    yield module
+    module._POOL.shutdown(wait=True)
+
+
+def test_pool_is_replaced_after_a_worker_dies(main):
+    async def run():
+        with pytest.raises(BrokenProcessPool):
+            await main.run_in_pool(os._exit, 1)
+        return await main.run_in_pool(abs, -1)
+
+    assert asyncio.run(run()) == 1
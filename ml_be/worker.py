@@ -0,0 +1,32 @@
+import os
+
+# Entry points run in the aggregation worker processes. This module is imported by the
+# API process, so it must not import TensorFlow at module level: `aggregator` is only
+# imported inside the functions, which execute in the workers.
+
+def aggregate_and_save(
+    model_paths: list[str], output_path: str, sample_counts: list[int] | None = None, reference_path: str | None = None
+) -> str:
+    """
+    Aggregates the given models and saves the resulting global model, see
+    `aggregator.aggregate_and_save`.
+
+    Returns:
+        str: The absolute path of the saved global model.
+    """
+    from aggregator import aggregate_and_save
+    return aggregate_and_save(model_paths, output_path, sample_counts, reference_path)
+
+def create_test_models(num_models: int, test_dir: str, dtype: str = 'float32') -> str:
+    """
+    Saves `num_models` dummy models as `local_model_<i>.h5` files in `test_dir`.
+
+    Returns:
+        str: The absolute path of `test_dir`.
+    """
+    from aggregator import create_dummy_model
+    os.makedirs(test_dir, exist_ok=True)
+    for i in range(num_models):
+        model = create_dummy_model(dtype)
+        model.save(os.path.join(test_dir, f'local_model_{i+1}.h5'))
+    return os.path.abspath(test_dir)